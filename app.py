@@ -1,126 +1,260 @@
 
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import pandas as pd
+import numpy as np
 import io
-import unicodedata
-from typing import List, Tuple
-import chardet
-import re
+import codecs
+from typing import List, Optional, Tuple
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import zipfile
+import xlsxwriter
 
 st.set_page_config(page_title="Pix CSV Uploader (BS2) – Consolidador", page_icon="💳", layout="wide")
 
 # ---------- Utils ----------
+STR_DTYPE = "string[pyarrow]"  # texto contíguo em Arrow em vez de objetos Python por célula
+UTF8_CHECK_CHUNK = 1 << 16
+
 def detect_encoding(b: bytes) -> str:
+    # Extratos BS2 vêm em utf-8(-sig) ou cp1252/latin1; cp1252 decodifica aspas/travessão/€ (0x80-0x9F)
     if b.startswith(b"\xef\xbb\xbf"):
         return "utf-8-sig"
-    guess = chardet.detect(b)
-    enc = (guess.get("encoding") or "utf-8").lower()
-    if enc in ("iso-8859-1", "latin-1", "latin1"):
-        return "latin1"
-    return enc
-
-def normalize_text(s: str) -> str:
-    if s is None:
-        return ""
-    s = str(s)
-    s = unicodedata.normalize("NFKD", s)
-    s = "".join(ch for ch in s if not unicodedata.combining(ch))
-    return s.lower().strip()
+    if b.startswith((b"\xff\xfe", b"\xfe\xff")):
+        return "utf-16"
+    # Validação em blocos: não materializa o arquivo inteiro como str
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    view = memoryview(b)
+    try:
+        for i in range(0, len(view), UTF8_CHECK_CHUNK):
+            decoder.decode(view[i:i + UTF8_CHECK_CHUNK])
+        decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        return "cp1252"
+    return "utf-8"
+
+def normalize_text(series: pd.Series) -> pd.Series:
+    # NFKD + ascii/ignore descarta os acentos (marcas combinantes) em C, sem loop Python por linha
+    return (series.fillna("").astype(STR_DTYPE)
+            .str.normalize("NFKD")
+            .str.encode("ascii", "ignore")
+            .str.decode("ascii")
+            .str.lower()
+            .str.strip())
+
+# NBSP, espaço e milhar removidos; menos unicode -> "-"; decimal "," -> "."
+_VAL_TRANSLATE = str.maketrans({"\u00A0": None, " ": None, ".": None, "\u2212": "-", ",": "."})
+# Mantido como str: em string[pyarrow] um re.Pattern compilado força o fallback Python por elemento,
+# enquanto o padrão em texto é compilado uma vez por chamada pelo kernel Arrow
+_TRAIL_MINUS_PAT = r"^([0-9.]+)-$"
 
 def clean_val(series: pd.Series) -> pd.Series:
-    s = series.astype(str)
-    s = s.str.replace("\u00A0", "", regex=False)  # NBSP
+    s = series.astype(STR_DTYPE)
     s = s.str.replace("R$", "", regex=False)
-    s = s.str.replace(" ", "", regex=False)
-    s = s.str.replace("\u2212", "-", regex=False)  # unicode minus
-    s = s.str.replace(r"^([0-9\.,]+)-$", r"-\1", regex=True)  # 0,45- -> -0,45
-    s = s.str.replace(".", "", regex=False)  # thousands
-    s = s.str.replace(",", ".", regex=False)  # decimal
-    return pd.to_numeric(s, errors="coerce")
+    s = s.str.translate(_VAL_TRANSLATE)
+    s = s.str.replace(_TRAIL_MINUS_PAT, r"-\1", regex=True)  # 0.45- -> -0.45
+    return pd.to_numeric(s, errors="coerce").astype("float64")
+
+HEADER_SCAN_LINES = 40
+
+def find_header_offset(file_bytes: bytes) -> Optional[int]:
+    # O cabeçalho "Data;..." fica nas primeiras linhas: compara só 5 bytes por linha, sem decodificar
+    pos = 3 if file_bytes.startswith(b"\xef\xbb\xbf") else 0
+    for _ in range(HEADER_SCAN_LINES):
+        if file_bytes[pos:pos + 64].lstrip(b" \t")[:5].lower() == b"data;":
+            return pos
+        nl = file_bytes.find(b"\n", pos)
+        if nl == -1:
+            return None
+        pos = nl + 1
+    return None
+
+def canonical_col(col: str) -> str:
+    c = col.strip().lower()
+    if c.startswith("data"):
+        return "Data"
+    if c.startswith("tipo"):
+        return "Tipo"
+    if c.startswith("detalhe"):
+        return "Detalhe"
+    if "identificador" in c:
+        return "Identificador"
+    if c.startswith("valor"):
+        return "Valor"
+    if "observa" in c:
+        return "Observação"
+    return col.strip()
+
+def parse_data(raw: pd.Series) -> Tuple[pd.Series, int]:
+    # Caminho rápido no formato BS2; o que falhar tenta ISO 8601 e só então dd/mm com hora etc.
+    # (ISO antes do dayfirst: no pandas 3, "mixed" + dayfirst troca dia e mês em "2024-01-05")
+    data = pd.to_datetime(raw, format="%d/%m/%Y", errors="coerce")
+    preenchida = raw.str.strip().ne("")
+    for kwargs in ({"format": "ISO8601"}, {"format": "mixed", "dayfirst": True}):
+        retry = data.isna() & preenchida
+        if not retry.any():
+            break
+        data[retry] = pd.to_datetime(raw[retry], errors="coerce", **kwargs)
+    return data, int((data.isna() & preenchida).sum())
 
 def read_bs2_csv(file_bytes: bytes) -> pd.DataFrame:
     enc = detect_encoding(file_bytes)
-    text = file_bytes.decode(enc, errors="replace")
-    lines = text.splitlines()
-    header_idx = None
-    for i, line in enumerate(lines):
-        if line.strip().lower().startswith("data;"):
-            header_idx = i
-            break
-    if header_idx is None:
+    if enc == "utf-16":
+        # A busca do cabeçalho é feita em bytes ASCII: converte o (raro) UTF-16 para UTF-8 antes
+        file_bytes = file_bytes.decode("utf-16", errors="replace").encode("utf-8")
+        enc = "utf-8"
+    header_offset = find_header_offset(file_bytes)
+    if header_offset is None:
         return pd.DataFrame()
-    sliced = "\n".join(lines[header_idx:])
-    from io import StringIO
-    df = pd.read_csv(StringIO(sliced), sep=";", dtype=str, keep_default_na=False)
-    df = df.rename(columns={c: c.strip() for c in df.columns})
-    rename_map = {}
-    for col in df.columns:
-        c = col.strip().lower()
-        if c.startswith("data"):
-            rename_map[col] = "Data"
-        elif c.startswith("tipo"):
-            rename_map[col] = "Tipo"
-        elif c.startswith("detalhe"):
-            rename_map[col] = "Detalhe"
-        elif "identificador" in c:
-            rename_map[col] = "Identificador"
-        elif c.startswith("valor"):
-            rename_map[col] = "Valor"
-        elif "observa" in c:
-            rename_map[col] = "Observação"
-    df = df.rename(columns=rename_map)
+    buf = io.BytesIO(file_bytes)
+    buf.seek(header_offset)
+    df = pd.read_csv(buf, sep=";", dtype=STR_DTYPE, keep_default_na=False,
+                     encoding=enc, encoding_errors="replace")
+    df = df.rename(columns=canonical_col)
     for c in ["Data","Tipo","Detalhe","Identificador","Valor","Observação"]:
         if c not in df.columns:
-            df[c] = ""
-    df["Valor_raw"] = df["Valor"]
+            df[c] = pd.Series("", index=df.index, dtype=STR_DTYPE)
+    df["Data"], datas_invalidas = parse_data(df["Data"])
     df["Valor"] = clean_val(df["Valor"])
-    return df[["Data","Tipo","Detalhe","Identificador","Valor","Observação","Valor_raw"]]
-
-def consolidate(files: List[Tuple[str, bytes]]) -> pd.DataFrame:
-    frames = []
-    for name, content in files:
-        df = read_bs2_csv(content)
-        if not df.empty:
-            df = df.copy()
-            df["Arquivo"] = name
-            frames.append(df)
+    df = df[["Data","Tipo","Detalhe","Identificador","Valor","Observação"]]
+    df.attrs["datas_invalidas"] = datas_invalidas
+    return df
+
+# Valores de Tipo_norm (já normalizado): comparação exata, sem regex
+TIPO_TARIFA = "tarifa operacoes pix"
+TIPO_DEVOL = "devolucao recebida pix"
+
+UploadedFile = Tuple[str, bytes, bytes]  # (name, digest, content)
+FilesKey = Tuple[Tuple[str, bytes], ...]
+
+def file_digest(content: bytes) -> bytes:
+    return hashlib.blake2b(content, digest_size=16).digest()
+
+def files_key(files: List[UploadedFile]) -> FilesKey:
+    # Chave barata para st.cache_data: evita que o Streamlit faça hash de DataFrames/bytes a cada rerun
+    return tuple((name, digest) for name, digest, _ in files)
+
+# Cache compartilhado entre sessões e chaveado pelo conjunto de arquivos: cada "Adicionar"
+# gera uma entrada nova, então os resultados consolidados ficam limitados
+CACHE_MAX_ENTRIES = 8
+
+@st.cache_data(show_spinner=False, max_entries=128)
+def read_bs2_csv_cached(digest: bytes, _content: bytes) -> pd.DataFrame:
+    return read_bs2_csv(_content)
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def consolidate(_files: List[UploadedFile], key: FilesKey) -> pd.DataFrame:
+    # Mesmas categorias em todos os frames para o concat manter Arquivo como categórico
+    names = list(dict.fromkeys(name for name, _, _ in _files))
+    codes = {name: i for i, name in enumerate(names)}
+    frames: List[Optional[pd.DataFrame]] = [None] * len(_files)
+    sem_cabecalho: List[Optional[str]] = [None] * len(_files)
+
+    def parse(i: int) -> None:
+        name, digest, content = _files[i]
+        df = read_bs2_csv_cached(digest, content)
+        if df.columns.empty:
+            sem_cabecalho[i] = name
+        elif not df.empty:
+            df["Arquivo"] = pd.Categorical.from_codes(np.full(len(df), codes[name]), categories=names)
+            frames[i] = df
+
+    # read_csv/clean_val liberam o GIL na parte em C: parse dos arquivos em paralelo.
+    # Os workers herdam o ScriptRunContext para usar st.cache_data sem o aviso "missing ScriptRunContext"
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(_files))),
+                            initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)) as ex:
+        list(ex.map(parse, range(len(_files))))
+    frames = [df for df in frames if df is not None]
+    attrs = {
+        "datas_invalidas": sum(df.attrs.get("datas_invalidas", 0) for df in frames),
+        "sem_cabecalho": [name for name in sem_cabecalho if name is not None],
+    }
     if not frames:
-        return pd.DataFrame(columns=["Arquivo","Data","Tipo","Detalhe","Identificador","Valor","Observação","Valor_raw"])
-    return pd.concat(frames, ignore_index=True)
+        df = pd.DataFrame(columns=["Arquivo","Data","Tipo","Detalhe","Identificador","Valor","Observação","Tipo_norm"])
+        df.attrs = attrs
+        return df
+    # Sem copy=False: obsoleto no pandas 3, onde o copy-on-write já evita a cópia
+    df = pd.concat(frames, ignore_index=True)
+    df["Tipo_norm"] = pd.Categorical(normalize_text(df["Tipo"]))
+    df.attrs = attrs
+    return df
 
-def filter_and_totals(df: pd.DataFrame):
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def filter_and_totals(_df: pd.DataFrame, key: FilesKey):
+    df = _df
     if df.empty:
-        return df.copy(), df.copy(), 0.0, 0.0
-    tipo_norm = df["Tipo"].map(normalize_text)
-    tarifa_mask = tipo_norm.str.contains("tarifa operacoes pix", na=False)
-    devol_mask = tipo_norm.str.contains("devolucao recebida pix", na=False)
-    tarifa = df[tarifa_mask].copy()
-    devol = df[devol_mask].copy()
+        return df, df, 0.0, 0.0
+    tarifa_mask = df["Tipo_norm"] == TIPO_TARIFA
+    devol_mask = df["Tipo_norm"] == TIPO_DEVOL
+    # sort_values já devolve um frame novo: sem .copy() extra
+    tarifa = df[tarifa_mask].sort_values(by="Data", na_position="last")
+    devol = df[devol_mask].sort_values(by="Data", na_position="last")
     total_tarifa = float(tarifa["Valor"].sum()) if not tarifa.empty else 0.0
     total_devol = float(devol["Valor"].sum()) if not devol.empty else 0.0
     return tarifa, devol, total_tarifa, total_devol
 
-def to_excel_bytes(total_tarifa: float, total_devol: float, devol: pd.DataFrame, tarifa: pd.DataFrame) -> bytes:
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def resumo_por_arquivo(_df: pd.DataFrame, key: FilesKey) -> pd.DataFrame:
+    df = _df
+    is_tarifa = df["Tipo_norm"] == TIPO_TARIFA
+    is_devol = df["Tipo_norm"] == TIPO_DEVOL
+    return pd.DataFrame({
+        "Arquivo": df["Arquivo"],
+        "Valor": df["Valor"],
+        "v_tarifa": df["Valor"].where(is_tarifa, 0.0),
+        "v_devol": df["Valor"].where(is_devol, 0.0),
+    }).groupby("Arquivo", sort=False, observed=True).agg(
+        linhas=("Valor", "size"),
+        total_tarifa=("v_tarifa", "sum"),
+        total_devol=("v_devol", "sum"),
+    ).reset_index()
+
+EXPORT_COLS = ["Arquivo","Data","Tipo","Detalhe","Identificador","Valor","Observação"]
+
+def _excel_value(v):
+    return None if pd.isna(v) else v
+
+def _export_cols(df: pd.DataFrame) -> pd.DataFrame:
+    if df.empty:
+        return pd.DataFrame(columns=EXPORT_COLS)
+    return df[[c for c in EXPORT_COLS if c in df.columns]]
+
+def _export_frames(total_tarifa: float, total_devol: float, devol: pd.DataFrame, tarifa: pd.DataFrame) -> List[Tuple[str, pd.DataFrame]]:
+    resumo = pd.DataFrame({
+        "Transação": ["Total Tarifa Operações Pix", "Total Devolução Recebida Pix"],
+        "Valor Total (R$)": [round(total_tarifa, 2), round(total_devol, 2)]
+    })
+    return [
+        ("Resumo Tarifa Pix", resumo),
+        ("Devolução Recebida Pix", _export_cols(devol)),
+        ("Detalhe Tarifas Pix", _export_cols(tarifa)),
+    ]
+
+def _write_sheet(wb: xlsxwriter.Workbook, title: str, df: pd.DataFrame) -> None:
+    ws = wb.add_worksheet(title)
+    ws.write_row(0, 0, list(df.columns))
+    for r, row in enumerate(df.itertuples(index=False, name=None), start=1):
+        ws.write_row(r, 0, [_excel_value(v) for v in row])
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def to_excel_bytes(total_tarifa: float, total_devol: float, _devol: pd.DataFrame, _tarifa: pd.DataFrame, key: FilesKey) -> bytes:
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-        pd.DataFrame({
-            "Transação": ["Total Tarifa Operações Pix", "Total Devolução Recebida Pix"],
-            "Valor Total (R$)": [round(total_tarifa, 2), round(total_devol, 2)]
-        }).to_excel(writer, index=False, sheet_name="Resumo Tarifa Pix")
-
-        if not devol.empty:
-            cols = [c for c in ["Arquivo","Data","Tipo","Detalhe","Identificador","Valor","Observação"] if c in devol.columns]
-            devol.sort_values(by="Data", inplace=True, na_position="last")
-            devol[cols].to_excel(writer, index=False, sheet_name="Devolução Recebida Pix")
-        else:
-            pd.DataFrame(columns=["Arquivo","Data","Tipo","Detalhe","Identificador","Valor","Observação"]).to_excel(writer, index=False, sheet_name="Devolução Recebida Pix")
+    wb = xlsxwriter.Workbook(output, {"constant_memory": True, "default_date_format": "dd/mm/yyyy"})
+    for title, df in _export_frames(total_tarifa, total_devol, _devol, _tarifa):
+        _write_sheet(wb, title, df)
+    wb.close()
+    return output.getvalue()
 
-        if not tarifa.empty:
-            cols_t = [c for c in ["Arquivo","Data","Tipo","Detalhe","Identificador","Valor","Observação"] if c in tarifa.columns]
-            tarifa.sort_values(by="Data", inplace=True, na_position="last")
-            tarifa[cols_t].to_excel(writer, index=False, sheet_name="Detalhe Tarifas Pix")
-        else:
-            pd.DataFrame(columns=["Arquivo","Data","Tipo","Detalhe","Identificador","Valor","Observação"]).to_excel(writer, index=False, sheet_name="Detalhe Tarifas Pix")
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def to_csv_zip_bytes(total_tarifa: float, total_devol: float, _devol: pd.DataFrame, _tarifa: pd.DataFrame, key: FilesKey) -> bytes:
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for title, df in _export_frames(total_tarifa, total_devol, _devol, _tarifa):
+            with zf.open(f"{title}.csv", "w") as fh:
+                df.to_csv(fh, sep=";", decimal=",", date_format="%d/%m/%Y", index=False, encoding="utf-8-sig")
     return output.getvalue()
 
 # ---------- UI ----------
@@ -128,7 +262,7 @@ st.title("💳 Pix CSV Uploader (BS2) – Consolidador")
 st.caption("Envie múltiplos CSVs do extrato BS2; o app consolida automaticamente e gera um Excel com 3 abas.")
 
 if "files" not in st.session_state:
-    st.session_state["files"] = []  # list of (name, bytes)
+    st.session_state["files"] = []  # list of (name, digest, bytes)
 
 with st.container(border=True):
     st.subheader("Upload de arquivos")
@@ -137,12 +271,13 @@ with st.container(border=True):
     with colA:
         if st.button("➕ Adicionar à consolidação", type="primary", disabled=not files):
             added = 0
-            existing_keys = set((n, len(b)) for n,b in st.session_state["files"])
+            existing_keys = {d for _, d, _ in st.session_state["files"]}
             for f in files or []:
                 content = f.getvalue()
-                key = (f.name, len(content))
-                if key not in existing_keys:
-                    st.session_state["files"].append((f.name, content))
+                digest = file_digest(content)
+                if digest not in existing_keys:
+                    st.session_state["files"].append((f.name, digest, content))
+                    existing_keys.add(digest)
                     added += 1
             st.success(f"{added} arquivo(s) adicionado(s).")
     with colB:
@@ -153,13 +288,19 @@ with st.container(border=True):
     # Preview
     if st.session_state["files"]:
         st.write(f"**Arquivos na consolidação:** {len(st.session_state['files'])}")
-        for i, (name, content) in enumerate(st.session_state["files"], start=1):
+        for i, (name, _, content) in enumerate(st.session_state["files"], start=1):
             st.write(f"{i}. {name} — {len(content)/1024:.1f} KB")
 
 # Processamento
 if st.session_state["files"]:
-    df_all = consolidate(st.session_state["files"])
-    tarifa, devol, total_tarifa, total_devol = filter_and_totals(df_all)
+    cache_key = files_key(st.session_state["files"])
+    df_all = consolidate(st.session_state["files"], cache_key)
+    tarifa, devol, total_tarifa, total_devol = filter_and_totals(df_all, cache_key)
+
+    if df_all.attrs.get("sem_cabecalho"):
+        st.warning("Arquivo(s) sem cabeçalho \"Data;\" reconhecido, ignorado(s): " + ", ".join(df_all.attrs["sem_cabecalho"]))
+    if df_all.attrs.get("datas_invalidas"):
+        st.warning(f"{df_all.attrs['datas_invalidas']} linha(s) com Data em formato não reconhecido; ficarão em branco na exportação.")
 
     st.divider()
     st.subheader("Indicadores consolidados")
@@ -176,36 +317,38 @@ if st.session_state["files"]:
     # Resumo por arquivo
     st.markdown("### Resumo por arquivo")
     if not df_all.empty:
-        df_tmp = df_all.copy()
-        df_tmp["Tipo_norm"] = df_tmp["Tipo"].map(normalize_text)
-        resumo_arquivo = df_tmp.groupby("Arquivo").apply(
-            lambda g: pd.Series({
-                "linhas": int(g.shape[0]),
-                "total_tarifa": float(g.loc[g["Tipo_norm"].eq("tarifa operacoes pix"), "Valor"].sum()),
-                "total_devol": float(g.loc[g["Tipo_norm"].eq("devolucao recebida pix"), "Valor"].sum()),
-            })
-        ).reset_index()
+        resumo_arquivo = resumo_por_arquivo(df_all, cache_key)
         st.dataframe(resumo_arquivo, use_container_width=True)
 
-    with st.expander("Ver prévia de Devoluções"):
+    # st.expander sempre serializa o conteúdo; com toggle a prévia só é montada quando aberta
+    if st.toggle("Ver prévia de Devoluções", key="show_devol"):
         if devol.empty:
             st.info("Nenhuma Devolução Recebida Pix encontrada.")
         else:
-            st.dataframe(devol.head(50), use_container_width=True)
+            st.dataframe(_export_cols(devol).head(50), use_container_width=True)
 
-    with st.expander("Ver prévia de Tarifas"):
+    if st.toggle("Ver prévia de Tarifas", key="show_tarifa"):
         if tarifa.empty:
             st.info("Nenhuma Tarifa Operações Pix encontrada.")
         else:
-            st.dataframe(tarifa.head(50), use_container_width=True)
-
-    excel_bytes = to_excel_bytes(total_tarifa, total_devol, devol, tarifa)
-    st.download_button(
-        "⬇️ Baixar Excel consolidado",
-        data=excel_bytes,
-        file_name="resultado_pix_consolidado.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        type="primary"
-    )
+            st.dataframe(_export_cols(tarifa).head(50), use_container_width=True)
+
+    as_csv = st.checkbox("Exportar como CSV (.zip)", help="Mais rápido para consolidações muito grandes")
+    if as_csv:
+        st.download_button(
+            "⬇️ Baixar CSVs consolidados",
+            data=to_csv_zip_bytes(total_tarifa, total_devol, devol, tarifa, cache_key),
+            file_name="resultado_pix_consolidado.csv.zip",
+            mime="application/zip",
+            type="primary"
+        )
+    else:
+        st.download_button(
+            "⬇️ Baixar Excel consolidado",
+            data=to_excel_bytes(total_tarifa, total_devol, devol, tarifa, cache_key),
+            file_name="resultado_pix_consolidado.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            type="primary"
+        )
 else:
     st.info("Adicione arquivos para ver os indicadores e habilitar o download do Excel.")
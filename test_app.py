@@ -0,0 +1,19 @@
+import pandas as pd
+
+from app import parse_data
+
+
+def test_parse_data_formats():
+    raw = pd.Series(
+        ["05/01/2024", "05/01/2024 10:30", "2024-01-05", "2024-01-05T10:00:00", "", "não é data"],
+        dtype="string[pyarrow]",
+    )
+    data, invalidas = parse_data(raw)
+    assert list(data[:4]) == [
+        pd.Timestamp("2024-01-05"),
+        pd.Timestamp("2024-01-05 10:30"),
+        pd.Timestamp("2024-01-05"),
+        pd.Timestamp("2024-01-05 10:00"),
+    ]
+    assert data[4:].isna().all()
+    assert invalidas == 1